@@ -5,73 +5,243 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import os
+import glob
+import hashlib
+import tempfile
 import pydeck as pdk
 
 import pyogrio
-from shapely.geometry import shape
-from shapely.ops import transform
+from pyogrio import raw
+import shapely
 import pyproj
+from scipy.spatial import cKDTree
+
+# Arrow-based reads need pyarrow and GDAL >= 3.6
+try:
+    import pyarrow  # noqa: F401
+    USE_ARROW = pyogrio.__gdal_version__ >= (3, 6, 0)
+except ImportError:
+    USE_ARROW = False
 
 # ================================
 # 1. LOAD SHAPEFILES (NO GEOPANDAS)
 # ================================
 
 @st.cache_data
-def load_shapefile(path):
-    df = pyogrio.read_dataframe(path)
-    df["geometry"] = df["geometry"].apply(shape)
+def load_shapefile(path, columns=None):
+    # Raw GDAL read: attribute columns plus WKB geometry, decoded in one
+    # vectorized shapely call; `columns` restricts which fields GDAL reads
+    if USE_ARROW:
+        meta, table = raw.read_arrow(path, columns=columns)
+        df = table.to_pandas()
+        wkb = df.pop(meta["geometry_name"] or "wkb_geometry").to_numpy()
+    else:
+        meta, _, wkb, field_data = raw.read(path, columns=columns)
+        df = pd.DataFrame(dict(zip(meta["fields"], field_data)))
+
+    df["geometry"] = shapely.from_wkb(wkb)
     return df
 
-@st.cache_data
-def load_data():
+@st.cache_resource
+def get_transformer(src, dst):
+    # Transformers are reusable PROJ handles: build each pipeline once
+    return pyproj.Transformer.from_crs(src, dst, always_xy=True)
+
+def to_wgs84(x, y):
+    # EPSG:27700 → EPSG:4326, returns (lon, lat) as numpy arrays
+    return get_transformer("EPSG:27700", "EPSG:4326").transform(x, y)
+
+CACHE_DIR = ".cache"
+CACHE_VERSION = 3  # bump when the cached table layout changes
+
+def shapefile_key(stem):
+    # Fingerprint of the files that make up a shapefile
+    h = hashlib.sha1()
+    for ext in (".shp", ".shx", ".dbf"):
+        with open(stem + ext, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def read_cache(deaths_cache, pumps_cache):
+    # Cached tables, or None if missing or unreadable (caller rebuilds)
+    try:
+        deaths = pd.read_parquet(deaths_cache)
+        pumps  = pd.read_parquet(pumps_cache)
+    except Exception:
+        return None
+    if "bounds" not in deaths.attrs:
+        return None
+    return deaths, pumps
+
+def write_cache(df, path):
+    # Write to a temp file in CACHE_DIR, then swap it in atomically so a
+    # crash or a concurrent writer never leaves a truncated cache file
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp, compression="zstd")
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def build_data(death_count_col, pump_id_col):
+
+    deaths = load_shapefile("Cholera_Deaths.shp", columns=[death_count_col])
+    pumps  = load_shapefile("Pumps.shp", columns=[pump_id_col])
+
+    # Keep the native EPSG:27700 coordinates (metres) for distances;
+    # one pass over each geometry array gives an (N, 2) x/y block
+    deaths_m_xy = shapely.get_coordinates(deaths.geometry.to_numpy())
+    pumps_m_xy  = shapely.get_coordinates(pumps.geometry.to_numpy())
+
+    # Convert EPSG:27700 → EPSG:4326 (deaths and pumps in one call)
+    all_xy = np.concatenate([deaths_m_xy, pumps_m_xy])
+    lon, lat = to_wgs84(all_xy[:, 0], all_xy[:, 1])
+
+    n = len(deaths)
+    deaths["lon"], deaths["lat"] = lon[:n], lat[:n]
+    pumps["lon"], pumps["lat"]   = lon[n:], lat[n:]
 
-    deaths = load_shapefile("Cholera_Deaths.shp")
-    pumps  = load_shapefile("Pumps.shp")
+    # Validate columns
+    if death_count_col not in deaths.columns:
+        st.error(f"Column '{death_count_col}' missing in Cholera_Deaths.shp")
+        st.stop()
+    if pump_id_col not in pumps.columns:
+        st.error(f"Column '{pump_id_col}' missing in Pumps.shp")
+        st.stop()
+
+    # Distance to nearest pump (k-d tree over the pumps, in metres)
+    tree = cKDTree(pumps_m_xy)
+    dists, idx = tree.query(deaths_m_xy, k=1, workers=-1)
+
+    deaths["dist_m"] = np.round(dists, 1)
+    deaths["pump_id"] = pumps[pump_id_col].to_numpy()[idx]
+    deaths["pump_idx"] = idx  # row of the nearest pump in `pumps`
+
+    # Geometry is not needed once lon/lat are extracted; keep plain,
+    # narrow columns (float32 is plenty for display coordinates)
+    deaths = deaths.drop(columns="geometry")
+    pumps  = pumps.drop(columns="geometry")
 
-    # Convert EPSG:27700 → EPSG:4326
-    transformer = pyproj.Transformer.from_crs(
-        "EPSG:27700", "EPSG:4326", always_xy=True
-    ).transform
+    deaths[["lon", "lat"]] = deaths[["lon", "lat"]].astype(np.float32)
+    pumps[["lon", "lat"]]  = pumps[["lon", "lat"]].astype(np.float32)
+    deaths[death_count_col] = deaths[death_count_col].astype(np.int16)
 
-    deaths["geometry"] = deaths["geometry"].apply(lambda g: transform(transformer, g))
-    pumps["geometry"]  = pumps["geometry"].apply(lambda g: transform(transformer, g))
+    # Extent of the deaths from the layer header, reprojected corner by corner;
+    # kept in the table's attrs so it is stored with the parquet cache
+    xmin, ymin, xmax, ymax = pyogrio.read_info("Cholera_Deaths.shp")["total_bounds"]
+    corner_lon, corner_lat = to_wgs84(
+        np.array([xmin, xmax, xmax, xmin]), np.array([ymin, ymin, ymax, ymax])
+    )
+    deaths.attrs["bounds"] = [
+        float(corner_lon.min()), float(corner_lat.min()),
+        float(corner_lon.max()), float(corner_lat.max())
+    ]
+
+    return deaths, pumps
 
-    # Extract coordinates
-    deaths["lon"] = deaths.geometry.x
-    deaths["lat"] = deaths.geometry.y
-    pumps["lon"]  = pumps.geometry.x
-    pumps["lat"]  = pumps.geometry.y
+@st.cache_data
+def load_data():
 
     # Required column names
     death_count_col = "Count"
     pump_id_col = "Id"
 
-    # Validate columns
-    if death_count_col not in deaths.columns:
-        st.error(f"Column '{death_count_col}' missing in Cholera_Deaths.shp")
-        st.stop()
-    if pump_id_col not in pumps.columns:
-        st.error(f"Column '{pump_id_col}' missing in Pumps.shp")
-        st.stop()
+    # Reuse the processed tables from disk while the shapefiles are unchanged
+    key = f"v{CACHE_VERSION}_{shapefile_key('Cholera_Deaths')}_{shapefile_key('Pumps')}"
+    deaths_cache = os.path.join(CACHE_DIR, f"cholera_{key}_deaths.parquet")
+    pumps_cache  = os.path.join(CACHE_DIR, f"cholera_{key}_pumps.parquet")
+
+    cached = read_cache(deaths_cache, pumps_cache)
+    if cached is not None:
+        deaths, pumps = cached
+    else:
+        deaths, pumps = build_data(death_count_col, pump_id_col)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            write_cache(deaths, deaths_cache)
+            write_cache(pumps, pumps_cache)
+        except OSError:
+            pass  # read-only filesystem: just skip the disk cache
+        else:
+            # Drop tables left by older shapefiles or cache versions
+            for path in glob.glob(os.path.join(CACHE_DIR, "cholera_*.parquet")):
+                if path not in (deaths_cache, pumps_cache):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
 
     # Total deaths
     total_deaths = int(deaths[death_count_col].sum())
 
-    # Distance to nearest pump
-    def nearest(row):
-        dists = pumps.geometry.distance(row.geometry)
-        idx = dists.idxmin()
-        return pd.Series({
-            "dist_m": round(dists.min(), 1),
-            "pump_id": pumps.loc[idx, pump_id_col]
-        })
+    # Extent of the deaths (lon/lat box for the 3D base layer)
+    bounds = tuple(deaths.attrs["bounds"])
+
+    # Histogram of deaths per location (counts start at 1)
+    counts = np.bincount(deaths[death_count_col].to_numpy().astype(np.int64))
+    count_dist = pd.Series(counts[1:], index=np.arange(1, counts.size))
+
+    # Deaths and mean distance per pump: one scatter-add over the
+    # nearest-pump index instead of a hash-based groupby
+    n_pumps = len(pumps)
+    pump_idx = deaths["pump_idx"].to_numpy()
+    sum_c = np.zeros(n_pumps, np.int64)
+    sum_d = np.zeros(n_pumps)
+    cnt = np.zeros(n_pumps, np.int64)
+    np.add.at(sum_c, pump_idx, deaths[death_count_col].to_numpy())
+    np.add.at(sum_d, pump_idx, deaths["dist_m"].to_numpy())
+    np.add.at(cnt, pump_idx, 1)
+
+    deaths_by_pump = pd.DataFrame(
+        {
+            death_count_col: sum_c,
+            # no nearest deaths: no mean distance (shown blank)
+            "dist_m": np.where(cnt > 0, sum_d / np.maximum(cnt, 1), np.nan),
+        },
+        index=pd.Index(pumps[pump_id_col].to_numpy(), name="pump_id"),
+    ).round(1).sort_values(death_count_col, ascending=False)
+
+    # Summary statistics for the analysis tab and sidebar
+    stats = {
+        "mean": deaths[death_count_col].mean(),
+        "max": int(deaths[death_count_col].max()),
+        "count_dist": count_dist,
+        "dist_mean": deaths["dist_m"].mean(),
+        "dist_max": deaths["dist_m"].max(),
+        "dist_min": deaths["dist_m"].min(),
+        "dist_q75": deaths["dist_m"].quantile(0.75),
+        "deaths_by_pump": deaths_by_pump,
+    }
+
+    return deaths, pumps, death_count_col, pump_id_col, total_deaths, stats, bounds
+
 
-    deaths[["dist_m", "pump_id"]] = deaths.apply(nearest, axis=1)
+deaths_gdf, pumps_gdf, count_col, pump_col, total_deaths, stats, bounds = load_data()
 
-    return deaths, pumps, death_count_col, pump_id_col, total_deaths
+# Layer data: convert each table to records once and share it across layers.
+# Arguments starting with "_" are not hashed; the data is fixed per process.
+@st.cache_resource
+def get_layer_records(_deaths, _pumps, count_col, pump_col):
+    # Only the columns each layer needs; coordinates rounded to 6 decimals
+    # (~0.1 m) so they serialise as short JSON numbers
+    coords = {"lon": 6, "lat": 6}
+    deaths = _deaths[["lon", "lat", count_col, "dist_m", "pump_id"]].astype(
+        {"lon": "float64", "lat": "float64", "pump_id": "int32"}
+    ).round(coords)
+    pumps = _pumps[["lon", "lat", pump_col]].astype(
+        {"lon": "float64", "lat": "float64", pump_col: "int32"}
+    ).round(coords)
 
+    deaths_records = deaths.assign(type="death").to_dict("records")
+    weight_records = deaths[["lon", "lat", count_col]].to_dict("records")
+    pumps_records  = pumps.assign(type="pump").to_dict("records")
+    return deaths_records, weight_records, pumps_records
 
-deaths_gdf, pumps_gdf, count_col, pump_col, total_deaths = load_data()
+deaths_records, weight_records, pumps_records = get_layer_records(
+    deaths_gdf, pumps_gdf, count_col, pump_col
+)
 
 
 # ================================
@@ -133,6 +303,34 @@ tab1, tab2, tab3 = st.tabs(["🎯 2D Interactive Map", "🏗️ 3D Extruded Map"
 # 3. 2D MAP
 # ================================
 
+@st.cache_resource
+def get_2d_layers(_weight_records, _pumps_records, count_col):
+    # One GPU aggregation pass gives both the density and per-cell totals
+    deaths_grid_2d = pdk.Layer(
+        "GridLayer",
+        data=_weight_records,
+        get_position=["lon", "lat"],
+        get_color_weight=count_col,
+        color_range=[
+            [254, 229, 217], [252, 187, 161], [252, 146, 114],
+            [251, 106, 74], [222, 45, 38], [165, 15, 21]
+        ],
+        cell_size=8,
+        extruded=False,
+        pickable=True
+    )
+
+    pumps_layer_2d = pdk.Layer(
+        "ScatterplotLayer",
+        data=_pumps_records,
+        get_position=["lon", "lat"],
+        get_radius=10,
+        get_fill_color=[30, 100, 255, 255],
+        pickable=True
+    )
+
+    return deaths_grid_2d, pumps_layer_2d
+
 with tab1:
     st.markdown('<div class="section-header">🎯 2D Interactive Map – Deaths and Pumps Combined</div>', unsafe_allow_html=True)
 
@@ -140,10 +338,9 @@ with tab1:
         "html": """
         {% if feature.properties.type == 'death' %}
         <div class="death-tooltip">
-            <b>💀 CHOLERA DEATH</b><br>
-            <b>Deaths at this location:</b> {Count}<br>
-            <b>Nearest Pump ID:</b> {pump_id}<br>
-            <b>Distance to Pump:</b> {dist_m} meters
+            <b>💀 CHOLERA DEATHS</b><br>
+            <b>Deaths in this cell:</b> {colorValue}<br>
+            <b>Death locations:</b> {count}
         </div>
         {% elif feature.properties.type == 'pump' %}
         <div class="pump-tooltip">
@@ -155,37 +352,12 @@ with tab1:
         "style": {"fontSize": "14px"}
     }
 
-    deaths_gdf["type"] = "death"
-    pumps_gdf["type"] = "pump"
-
-    deaths_layer_2d = pdk.Layer(
-        "ScatterplotLayer",
-        data=deaths_gdf,
-        get_position=["lon", "lat"],
-        get_radius=4,
-        get_fill_color=[220, 38, 38, 255],
-        pickable=True
-    )
-
-    pumps_layer_2d = pdk.Layer(
-        "ScatterplotLayer",
-        data=pumps_gdf,
-        get_position=["lon", "lat"],
-        get_radius=10,
-        get_fill_color=[30, 100, 255, 255],
-        pickable=True
-    )
-
-    heatmap_layer = pdk.Layer(
-        "HeatmapLayer",
-        data=deaths_gdf,
-        get_position=["lon", "lat"],
-        get_weight=count_col,
-        radius_pixels=80
+    deaths_grid_2d, pumps_layer_2d = get_2d_layers(
+        weight_records, pumps_records, count_col
     )
 
     st.pydeck_chart(pdk.Deck(
-        layers=[heatmap_layer, deaths_layer_2d, pumps_layer_2d],
+        layers=[deaths_grid_2d, pumps_layer_2d],
         initial_view_state=pdk.ViewState(
             latitude=51.5134,
             longitude=-0.1368,
@@ -200,11 +372,10 @@ with tab1:
 # 4. 3D MAP
 # ================================
 
-with tab2:
-    st.markdown('<div class="section-header">🏗️ 3D Map – Enhanced Visualization</div>', unsafe_allow_html=True)
-
-    min_lon, max_lon = deaths_gdf.lon.min(), deaths_gdf.lon.max()
-    min_lat, max_lat = deaths_gdf.lat.min(), deaths_gdf.lat.max()
+@st.cache_resource
+def get_base_layer(bounds):
+    # Bounding box of the deaths; built once, not on every slider change
+    min_lon, min_lat, max_lon, max_lat = bounds
 
     base_poly = [{
         "polygon": [
@@ -215,16 +386,18 @@ with tab2:
         ]
     }]
 
-    base_layer = pdk.Layer(
+    return pdk.Layer(
         "PolygonLayer",
         data=base_poly,
         get_polygon="polygon",
         get_fill_color=[245, 245, 245, 200]
     )
 
+@st.cache_resource
+def get_3d_layers(_deaths_records, _pumps_records, count_col):
     deaths_layer_3d = pdk.Layer(
         "ColumnLayer",
-        data=deaths_gdf,
+        data=_deaths_records,
         get_position=["lon", "lat"],
         disk_resolution=10,
         radius=5,
@@ -237,7 +410,7 @@ with tab2:
 
     pumps_layer_3d = pdk.Layer(
         "ColumnLayer",
-        data=pumps_gdf,
+        data=_pumps_records,
         get_position=["lon", "lat"],
         disk_resolution=16,
         radius=8,
@@ -247,6 +420,16 @@ with tab2:
         pickable=True
     )
 
+    return deaths_layer_3d, pumps_layer_3d
+
+with tab2:
+    st.markdown('<div class="section-header">🏗️ 3D Map – Enhanced Visualization</div>', unsafe_allow_html=True)
+
+    base_layer = get_base_layer(bounds)
+    deaths_layer_3d, pumps_layer_3d = get_3d_layers(
+        deaths_records, pumps_records, count_col
+    )
+
     combined_tooltip_3d = {
         "html": """
         {% if layer.id == 'deaths-layer' %}
@@ -296,29 +479,24 @@ with tab3:
         st.subheader("💀 Deaths Statistics")
         st.metric("Total Deaths", f"{total_deaths:,}")
         st.metric("Unique Death Locations", len(deaths_gdf))
-        st.metric("Avg Deaths per Location", f"{deaths_gdf[count_col].mean():.1f}")
-        st.metric("Max Deaths at a Location", int(deaths_gdf[count_col].max()))
+        st.metric("Avg Deaths per Location", f"{stats['mean']:.1f}")
+        st.metric("Max Deaths at a Location", stats["max"])
 
         st.subheader("Deaths Distribution")
-        st.bar_chart(deaths_gdf[count_col].value_counts().sort_index())
+        st.bar_chart(stats["count_dist"])
 
     with col2:
         st.subheader("🚰 Pump Statistics")
         st.metric("Total Pumps", len(pumps_gdf))
-        st.metric("Avg Distance to Nearest Pump", f"{deaths_gdf['dist_m'].mean():.1f} m")
-        st.metric("Max Distance to Pump", f"{deaths_gdf['dist_m'].max():.1f} m")
+        st.metric("Avg Distance to Nearest Pump", f"{stats['dist_mean']:.1f} m")
+        st.metric("Max Distance to Pump", f"{stats['dist_max']:.1f} m")
 
         st.subheader("Distance to Nearest Pump")
-        st.write(f"Closest: {deaths_gdf['dist_m'].min():.1f} m")
-        st.write(f"75% within: {deaths_gdf['dist_m'].quantile(0.75):.1f} m")
+        st.write(f"Closest: {stats['dist_min']:.1f} m")
+        st.write(f"75% within: {stats['dist_q75']:.1f} m")
 
     st.subheader("🔗 Deaths by Nearest Pump")
-    deaths_by_pump = deaths_gdf.groupby("pump_id").agg({
-        count_col: "sum",
-        "dist_m": "mean"
-    }).round(1).sort_values(count_col, ascending=False)
-
-    st.dataframe(deaths_by_pump)
+    st.dataframe(stats["deaths_by_pump"])
 
 
 # ================================
@@ -331,17 +509,17 @@ st.sidebar.subheader("📊 Data Summary")
 st.sidebar.markdown("**💀 Deaths Analysis**")
 st.sidebar.write(f"Total Deaths: **{total_deaths:,}**")
 st.sidebar.write(f"Death Locations: **{len(deaths_gdf)}**")
-st.sidebar.write(f"Avg Deaths per Location: **{deaths_gdf[count_col].mean():.1f}**")
+st.sidebar.write(f"Avg Deaths per Location: **{stats['mean']:.1f}**")
 
 st.sidebar.markdown("**🚰 Pumps Analysis**")
 st.sidebar.write(f"Total Pumps: **{len(pumps_gdf)}**")
-st.sidebar.write(f"Avg Distance to Pump: **{deaths_gdf['dist_m'].mean():.1f} m**")
+st.sidebar.write(f"Avg Distance to Pump: **{stats['dist_mean']:.1f} m**")
 
 st.sidebar.markdown("**🎨 Visualization Guide**")
 st.sidebar.markdown("""
-- 💀 **Red Points/Columns**: Deaths  
+- 💀 **Red Grid Cells/Columns**: Deaths  
 - 🚰 **Blue Points/Towers**: Pumps  
-- 🔥 **Heatmap**: Density of deaths  
+- 🔥 **Cell Shade**: Deaths per 8 m cell  
 - 🏗️ **3D Height**: Number of deaths  
 """)
 